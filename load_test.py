@@ -0,0 +1,362 @@
+# load_test.py
+###########
+# Load test for the openai helpers.
+# Runs N concurrent synthetic assistant sessions through handle_run_result, serve_tool_calls
+# and str_replace_editor against a local mock of the OpenAI client, then reports throughput,
+# turn latency percentiles, tool call mix, run state sequences, memory growth and CPU use.
+# No API calls are made.
+#
+# python load_test.py --sessions 50 --turns 5
+# python load_test.py --sessions 200 --latency-ms 300 --tool-mix view=5,str_replace=1,insert=1,lookup=3 --json
+#######
+
+# Standard library imports
+import os
+import sys
+import time
+import json
+import uuid
+import random
+import shutil
+import resource
+import argparse
+import threading
+import contextlib
+from collections import Counter
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+
+# openai_helpers creates an OpenAI client at import, it is replaced by the mock below
+os.environ.setdefault("OPENAI_API_KEY", "load-test")
+import openai_helpers
+
+LOAD_TEST_DIR = "load-test" # inside ASSISTANT_CHANGES_DIR
+TOOL_NAMES = ['view', 'str_replace', 'insert', 'lookup']
+
+### MOCK BACKEND
+class MockRuns:
+    """
+    Stands in for client.beta.threads.runs.
+    Each run walks through the configured pre-terminal states, one per retrieve, then either
+    requires_action with a round of synthetic tool calls or completes with usage data.
+    """
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.state_sequences = Counter()
+        self.tool_mix = Counter()
+        self.tool_output_chars = 0
+
+    def latency(self, rng):
+        if self.config.latency_ms <= 0:
+            return
+        time.sleep(rng.lognormvariate(0, self.config.latency_sigma) * self.config.latency_ms / 1000)
+
+    def create(self, thread_id, session, turn):
+        rng = session['rng']
+        run = {
+            'id': f"run_{uuid.uuid4().hex}",
+            'thread_id': thread_id,
+            'session': session,
+            'turn': turn,
+            'state_index': 0,
+            'rounds_left': rng.randint(*self.config.tool_rounds),
+            'status': self.config.states[0],
+            'sequence': [self.config.states[0]],
+        }
+        with self.lock:
+            self.runs[run['id']] = run
+        return self.run_object(run)
+
+    def retrieve(self, thread_id, run_id, **options):
+        run = self.runs[run_id]
+        self.latency(run['session']['rng'])
+        run['state_index'] += 1
+        if run['state_index'] < len(self.config.states):
+            run['status'] = self.config.states[run['state_index']]
+        elif run['rounds_left'] > 0:
+            run['status'] = 'requires_action'
+            run['tool_calls'] = self.make_tool_calls(run)
+        else:
+            run['status'] = 'completed'
+        run['sequence'].append(run['status'])
+        if run['status'] == 'completed':
+            with self.lock:
+                self.state_sequences['>'.join(run['sequence'])] += 1
+                del self.runs[run_id]
+        return self.run_object(run)
+
+    def submit_tool_outputs(self, thread_id, run_id, tool_outputs, **options):
+        run = self.runs[run_id]
+        expected = {tool_call.id for tool_call in run['tool_calls']}
+        if expected != {output['tool_call_id'] for output in tool_outputs}:
+            raise Exception(f"tool outputs don't match tool calls for {run_id}")
+        with self.lock:
+            self.tool_output_chars += sum(len(output['output']) for output in tool_outputs)
+        self.latency(run['session']['rng'])
+        run['rounds_left'] -= 1
+        run['state_index'] = 0
+        run['status'] = self.config.states[0]
+        run['sequence'].append(run['status'])
+        return self.run_object(run)
+
+    def cancel(self, thread_id, run_id, **options):
+        run = self.runs.pop(run_id)
+        run['status'] = 'cancelled'
+        run['sequence'].append('cancelled')
+        with self.lock:
+            self.state_sequences['>'.join(run['sequence'])] += 1
+        return self.run_object(run)
+
+    def make_tool_calls(self, run):
+        session = run['session']
+        rng = session['rng']
+        tool_calls = []
+        for _ in range(rng.randint(*self.config.tools_per_round)):
+            tool_name = rng.choices(TOOL_NAMES, weights=[self.config.tool_mix.get(name, 0) for name in TOOL_NAMES])[0]
+            tool_calls.append(make_tool_call(tool_name, session))
+            with self.lock:
+                self.tool_mix[tool_name] += 1
+        return tool_calls
+
+    def run_object(self, run):
+        required_action = None
+        if run['status'] == 'requires_action':
+            required_action = SimpleNamespace(
+                type='submit_tool_outputs',
+                submit_tool_outputs=SimpleNamespace(tool_calls=run['tool_calls'])
+            )
+        usage = None
+        if run['status'] == 'completed':
+            # prompt tokens grow with the conversation like a real thread
+            prompt_tokens = 1000 + 500 * run['turn']
+            usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=200, total_tokens=prompt_tokens + 200)
+        return SimpleNamespace(
+            id=run['id'],
+            thread_id=run['thread_id'],
+            status=run['status'],
+            model='mock-model',
+            created_at=int(time.time()),
+            completed_at=int(time.time()) if run['status'] == 'completed' else None,
+            required_action=required_action,
+            usage=usage
+        )
+
+def make_mock_client(runs):
+    mock_client = SimpleNamespace(beta=SimpleNamespace(threads=SimpleNamespace(runs=runs)))
+    # request options like timeout and max_retries don't apply to the mock
+    mock_client.with_options = lambda **options: mock_client
+    return mock_client
+
+def make_tool_call(tool_name, session):
+    """
+    Builds a synthetic tool call against the session's own file in the assistant workspace.
+    str_replace bumps a revision marker so every replacement has exactly one match.
+    """
+    path = session['path']
+    if tool_name == 'view':
+        function_name = 'str_replace_editor'
+        arguments = {'command': 'view', 'path': path}
+    elif tool_name == 'str_replace':
+        function_name = 'str_replace_editor'
+        revision = session['revision']
+        session['revision'] += 1
+        arguments = {'command': 'str_replace', 'path': path, 'old_str': f"<!-- rev {revision} -->", 'new_str': f"<!-- rev {revision + 1} -->"}
+    elif tool_name == 'insert':
+        function_name = 'str_replace_editor'
+        arguments = {'command': 'insert', 'path': path, 'insert_line': 1, 'new_str': f"<p>line {session['revision']}</p>"}
+    else:
+        function_name = 'lookup'
+        arguments = {'query': session['rng'].choice(['shipping', 'returns', 'sizes', 'stock'])}
+    return SimpleNamespace(
+        id=f"call_{uuid.uuid4().hex}",
+        function=SimpleNamespace(name=function_name, arguments=json.dumps(arguments))
+    )
+
+### SESSIONS
+def make_func_caller(config):
+    def call_custom_function(function_name, arguments):
+        # burn CPU like a real custom tool would
+        end = time.process_time() + config.lookup_cpu_ms / 1000
+        rows = []
+        while time.process_time() < end:
+            rows.append(sum(i * i for i in range(200)))
+        return json.dumps({'query': arguments.get('query'), 'rows': len(rows)})
+    return call_custom_function
+
+def session_thread_id(config, index):
+    return f"load_test_{config.run_label}_{index}"
+
+def run_session(index, config, runs, func_caller, turn_latencies, errors):
+    session = {
+        'rng': random.Random(config.seed + index),
+        'path': f"{LOAD_TEST_DIR}/session_{index}.html",
+        'revision': 0,
+    }
+    with open(os.path.join(openai_helpers.ASSISTANT_CHANGES_DIR, session['path']), 'w', encoding='utf-8') as f:
+        f.write("<html>\n<!-- rev 0 -->\n<body></body>\n</html>")
+
+    thread_id = session_thread_id(config, index)
+    for turn in range(config.turns):
+        run = runs.create(thread_id, session, turn)
+        start = time.perf_counter()
+        try:
+            openai_helpers.handle_run_result(
+                run=run,
+                thread_id=thread_id,
+                _func_caller=func_caller,
+                turn_timeout=config.turn_timeout
+            )
+            turn_latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(f"session {index} turn {turn}: {e}")
+
+### METRICS
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def current_rss_mb():
+    """
+    Current resident set size, from /proc on linux, falls back to peak RSS elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on linux and bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+def run_load_test(config):
+    runs = MockRuns(config)
+    openai_helpers.client = make_mock_client(runs)
+    openai_helpers.RUN_POLL_INTERVAL = config.poll_interval
+    func_caller = make_func_caller(config)
+    workspace_dir = os.path.join(openai_helpers.ASSISTANT_CHANGES_DIR, LOAD_TEST_DIR)
+    os.makedirs(workspace_dir, exist_ok=True)
+
+    turn_latencies = []
+    errors = []
+    rss_before = current_rss_mb()
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+
+    # the helpers print progress for every poll and tool call, keep it out of the report
+    output = sys.stdout if config.verbose else open(os.devnull, 'w')
+    with contextlib.redirect_stdout(output):
+        with ThreadPoolExecutor(max_workers=config.sessions) as executor:
+            futures = [
+                executor.submit(run_session, index, config, runs, func_caller, turn_latencies, errors)
+                for index in range(config.sessions)
+            ]
+            for future in futures:
+                future.result()
+    if not config.verbose:
+        output.close()
+
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_before
+    rss_after = current_rss_mb()
+    if not config.keep_files:
+        shutil.rmtree(workspace_dir, ignore_errors=True)
+        for index in range(config.sessions):
+            thread_id = session_thread_id(config, index)
+            shutil.rmtree(os.path.join("tmp", "logs", thread_id), ignore_errors=True)
+            openai_helpers.clear_tool_output_store(thread_id)
+
+    return {
+        'sessions': config.sessions,
+        'turns_per_session': config.turns,
+        'completed_turns': len(turn_latencies),
+        'failed_turns': len(errors),
+        'wall_seconds': round(wall, 3),
+        'throughput_turns_per_second': round(len(turn_latencies) / wall, 3) if wall else None,
+        'turn_latency_seconds': {
+            'p50': round(percentile(turn_latencies, 50), 4) if turn_latencies else None,
+            'p95': round(percentile(turn_latencies, 95), 4) if turn_latencies else None,
+            'p99': round(percentile(turn_latencies, 99), 4) if turn_latencies else None,
+            'max': round(max(turn_latencies), 4) if turn_latencies else None,
+        },
+        'tool_call_mix': dict(runs.tool_mix),
+        'submitted_tool_output_chars': runs.tool_output_chars,
+        'run_state_sequences': dict(runs.state_sequences.most_common(10)),
+        'memory_mb': {
+            'rss_before': round(rss_before, 1),
+            'rss_after': round(rss_after, 1),
+            'growth': round(rss_after - rss_before, 1),
+            'peak': round(peak_rss_mb(), 1),
+        },
+        'cpu': {
+            'cpu_seconds': round(cpu, 3),
+            'cores_used': round(cpu / wall, 2) if wall else None,
+        },
+        'errors': errors[:10],
+    }
+
+def print_report(report):
+    latency = report['turn_latency_seconds']
+    memory = report['memory_mb']
+    print(f"sessions: {report['sessions']} x {report['turns_per_session']} turns")
+    print(f"completed turns: {report['completed_turns']}, failed turns: {report['failed_turns']}")
+    print(f"wall time: {report['wall_seconds']}s, throughput: {report['throughput_turns_per_second']} turns/s")
+    print(f"turn latency: p50 {latency['p50']}s, p95 {latency['p95']}s, p99 {latency['p99']}s, max {latency['max']}s")
+    print(f"tool call mix: {report['tool_call_mix']}")
+    print(f"submitted tool output chars: {report['submitted_tool_output_chars']}")
+    print("run state sequences:")
+    for sequence, count in report['run_state_sequences'].items():
+        print(f"  {count} x {sequence}")
+    print(f"memory: {memory['rss_before']}MB -> {memory['rss_after']}MB (growth {memory['growth']}MB, peak {memory['peak']}MB)")
+    print(f"cpu: {report['cpu']['cpu_seconds']}s, {report['cpu']['cores_used']} cores used")
+    for error in report['errors']:
+        print(f"error: {error}")
+
+### CLI
+def parse_range(value):
+    low, _, high = value.partition('-')
+    return (int(low), int(high or low))
+
+def parse_tool_mix(value):
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        if name not in TOOL_NAMES:
+            raise argparse.ArgumentTypeError(f"unknown tool {name}, expected one of {TOOL_NAMES}")
+        mix[name] = float(weight or 1)
+    return mix
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate concurrent assistant sessions against a mock OpenAI backend.")
+    parser.add_argument('--sessions', type=int, default=20, help="concurrent sessions")
+    parser.add_argument('--turns', type=int, default=5, help="turns per session")
+    parser.add_argument('--tool-rounds', type=parse_range, default=(0, 3), help="requires_action rounds per turn, e.g. 0-3")
+    parser.add_argument('--tools-per-round', type=parse_range, default=(1, 3), help="tool calls per round, e.g. 1-3")
+    parser.add_argument('--tool-mix', type=parse_tool_mix, default=parse_tool_mix('view=4,str_replace=1,insert=1,lookup=2'), help="tool call weights, e.g. view=4,str_replace=1,insert=1,lookup=2")
+    parser.add_argument('--states', type=lambda value: value.split(','), default=['queued', 'in_progress'], help="run states before each terminal state, e.g. queued,in_progress,in_progress")
+    parser.add_argument('--latency-ms', type=float, default=50, help="median mock API latency per call")
+    parser.add_argument('--latency-sigma', type=float, default=0.5, help="lognormal sigma of the mock API latency")
+    parser.add_argument('--lookup-cpu-ms', type=float, default=5, help="CPU time burned by each lookup tool call")
+    parser.add_argument('--poll-interval', type=float, default=0.05, help="RUN_POLL_INTERVAL used by get_processed_run")
+    parser.add_argument('--turn-timeout', type=float, default=openai_helpers.TURN_TIMEOUT, help="per turn deadline in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the helpers' progress output")
+    parser.add_argument('--keep-files', action='store_true', help="keep the session files, logs and spilled tool outputs")
+    config = parser.parse_args(argv)
+    config.run_label = uuid.uuid4().hex[:8]
+    return config
+
+if __name__ == "__main__":
+    config = parse_args()
+    report = run_load_test(config)
+    if config.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
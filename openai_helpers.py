@@ -11,6 +11,9 @@ import time
 import json
 import logging
 import shutil
+import threading
+import concurrent.futures
+from collections import OrderedDict
 from os.path import join, dirname, exists
 from typing import Dict, Any, List, Union, Optional, Tuple
 from pathlib import Path
@@ -24,6 +27,9 @@ FILE_IDS = [] # keep track for deletion
 
 ### STR_REPLACE_EDITOR
 
+# assistant-changes directory - the only root the editor tool should use
+ASSISTANT_CHANGES_DIR = 'tmp/assistant-changes'
+
 # Helper function to escape special regex characters
 def escape_regexp(string: str) -> str:
     """Escape special regex characters in a string."""
@@ -64,8 +70,7 @@ def str_replace_editor(tool_call: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Dict with the response format for the user
     """
-    # Define assistant-changes directory - the only root we should use
-    assistant_changes_dir = 'tmp/assistant-changes'
+    assistant_changes_dir = ASSISTANT_CHANGES_DIR
 
     if not exists(assistant_changes_dir):
         raise Exception(f'This tool is hardcoded to make changes in the {assistant_changes_dir} directory. ensure it is created and handle by your code.')
@@ -362,45 +367,73 @@ def retrieve_assistant_by_id(assistant_id):
         print(f"Error retrieving assistant: {e}")
         return None
 
-# Create a directory for extension overrides if it doesn't exist
-TMP_EXT_OVERRIDES_DIR = os.path.join("tmp", "ext-overrides")
-os.makedirs(TMP_EXT_OVERRIDES_DIR, exist_ok=True)
+# Upload filename extension overrides for file types the vector store doesn't accept.
+# Matched against the end of the lowercased filename, longest extension first,
+# so compound extensions like .html.liquid win over .liquid.
+EXTENSION_OVERRIDES = {
+    '.html.liquid': '.html',
+    '.liquid': '.html',
+    '.htm': '.html',
+    '.erb': '.html',
+    '.hbs': '.html',
+    '.njk': '.html',
+    '.svelte': '.html',
+    '.vue': '.html',
+    '.scss': '.css',
+    '.sass': '.css',
+    '.less': '.css',
+    '.jsx': '.js',
+    '.mjs': '.js',
+    '.cjs': '.js',
+    '.tsx': '.ts',
+    '.mts': '.ts',
+    '.cts': '.ts',
+    '.jsonc': '.json',
+    '.markdown': '.md',
+    '.yml': '.txt',
+    '.yaml': '.txt',
+    '.toml': '.txt',
+    '.ini': '.txt',
+    '.cfg': '.txt',
+    '.csv': '.txt',
+    '.xml': '.txt',
+    '.svg': '.txt',
+    '.log': '.txt',
+}
+# Extensions that can't be uploaded to the vector store at all
+UNSUPPORTED_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico'}
+
+def get_upload_filename(file_path):
+    """
+    Returns the filename to upload file_path under, applying EXTENSION_OVERRIDES.
+    Raises if the extension is in UNSUPPORTED_EXTENSIONS.
+    """
+    base_name = os.path.basename(file_path)
+    lower_name = base_name.lower()
+    for ext in UNSUPPORTED_EXTENSIONS:
+        if lower_name.endswith(ext):
+            raise Exception(f"{ext.lstrip('.').upper()} files are not supported for vector store")
+    for ext in sorted(EXTENSION_OVERRIDES, key=len, reverse=True):
+        if lower_name.endswith(ext):
+            return base_name[:-len(ext)] + EXTENSION_OVERRIDES[ext]
+    return base_name
 
 def get_compatible_file_stream(file_path):
     """
     Creates a compatible file stream for the vector store.
-    If the file has an unsupported extension, it's copied to a tmp directory with a compatible extension.
+    If the file has an unsupported extension, the original file is opened and only
+    the name the stream reports (used as the upload filename) is changed, nothing is copied.
     Args:
         file_path: Path to the original file
     Returns:
         file_stream
     """
-    # Get the base name and extension
-    base_name = os.path.basename(file_path)
-    name, ext = os.path.splitext(base_name)
+    upload_filename = get_upload_filename(file_path)
+    file_stream = open(file_path, "rb")
 
     # override unsupported file extensions
-    new_ext = ext
-    if ext == '.scss':
-        new_ext = '.css'
-    elif ext == '.html.liquid':
-        new_ext = '.html'
-    elif ext == '.png':
-        raise Exception("PNG files are not supported for vector store")
-
-    # If the extension is already compatible, just open the original file
-    if new_ext == ext:
-        file_stream = open(file_path, "rb")
-        return file_stream
-
-    # Create a new file in the tmp directory with the compatible extension
-    new_filename = name + new_ext
-    new_path = os.path.join(TMP_EXT_OVERRIDES_DIR, new_filename)
-
-    # Copy the content from the original file to the new file
-    shutil.copy2(file_path, new_path)
-    # Open the new file for the vector store
-    file_stream = open(new_path, "rb")
+    if upload_filename != os.path.basename(file_path):
+        file_stream.raw.name = upload_filename
 
     return file_stream
 
@@ -494,62 +527,151 @@ def print_message_history(thread_id):
                     print("Not yet implemented for handling content type {}".format(content.type))
 
 
-def get_processed_run(run, thread_id):
+RUN_POLL_INTERVAL = 3.3 # seconds between run status polls
+RUN_POLL_MAX_ITER = 100 # polls before giving up on a run
+
+def get_processed_run(run, thread_id, deadline=None):
     if run.status == "expired":
         raise Exception("Assistant run expired {}".format(run))
-    MAX_ITER=100 # 30 seconds max
-    SLEEP=3.3
+    MAX_ITER=RUN_POLL_MAX_ITER
+    SLEEP=RUN_POLL_INTERVAL
     i = 0
     is_incomplete_status = (run.status == 'queued' or run.status == 'in_progress')
     print("polling run {} ".format(run.id),end="")
     while is_incomplete_status and i < MAX_ITER:
-        run = client.beta.threads.runs.retrieve(
-            thread_id=thread_id,
-            run_id=run.id
+        if deadline_exceeded(deadline):
+            cancel_run(run.id, thread_id)
+            raise Exception('Assistant turn deadline exceeded while run {} was {}: run cancelled'.format(run.id,run.status))
+        run_id = run.id
+        run = call_api_with_deadline(
+            lambda api: api.beta.threads.runs.retrieve(
+                thread_id=thread_id,
+                run_id=run_id
+            ),
+            deadline, run_id, thread_id, 'polling'
         )
         is_incomplete_status = (run.status == 'queued' or run.status == 'in_progress')
         print(".",end="")
-        time.sleep(SLEEP)
+        if is_incomplete_status:
+            time.sleep(SLEEP if deadline is None else max(0, min(SLEEP, time_remaining(deadline))))
         i += 1
     if is_incomplete_status:
+        cancel_run(run.id, thread_id)
         raise Exception('Assistant stuck with {} status: TIMEOUT after {} seconds'.format(run.status,SLEEP*MAX_ITER))
     else:
         return run
 
+### Deadlines
+# A turn (one call to handle_run_result from the chat loop) gets a single time budget.
+# The deadline is an absolute time.monotonic() value threaded through polling,
+# tool execution and submission. When it runs out the run is cancelled server-side.
+TURN_TIMEOUT = 300 # seconds, set to None to disable the turn deadline
+CANCEL_REQUEST_TIMEOUT = 5 # seconds, cancelling happens after the deadline so it gets its own small budget
+USE_TURN_TIMEOUT = object() # default for timeout arguments, read TURN_TIMEOUT at call time
+# Tool calls run inline on the caller's thread, so tools can keep using thread bound
+# resources (sqlite connections, thread local sessions) and the deadline is checked
+# around each call. Set TOOL_CALL_THREADS = True to run each call on its own daemon
+# thread instead, so an overrunning tool is abandoned at the deadline.
+TOOL_CALL_THREADS = False
+
+def make_deadline(timeout=USE_TURN_TIMEOUT):
+    if timeout is USE_TURN_TIMEOUT:
+        timeout = TURN_TIMEOUT
+    if timeout is None:
+        return None
+    return time.monotonic() + timeout
+
+def time_remaining(deadline):
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def deadline_client(deadline):
+    """
+    Returns the client to make an API call with inside a turn. With a deadline the
+    request is bounded by the remaining time and not retried, since every retry
+    would get the full remaining budget again.
+    """
+    if deadline is None:
+        return client
+    return client.with_options(timeout=max(0.1, time_remaining(deadline)), max_retries=0)
+
+def call_api_with_deadline(request, deadline, run_id, thread_id, action):
+    """
+    Calls request(api_client) with the deadline bounded client.
+    If the call fails once the deadline has passed (typically its own timeout)
+    the run is cancelled before raising.
+    """
+    try:
+        return request(deadline_client(deadline))
+    except Exception as e:
+        if deadline_exceeded(deadline):
+            cancel_run(run_id, thread_id)
+            raise Exception('Assistant turn deadline exceeded while {}: run {} cancelled'.format(action, run_id)) from e
+        raise
+
+def deadline_exceeded(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+def cancel_run(run_id, thread_id):
+    """
+    Cancels a run server-side so it stops consuming capacity.
+    Returns the cancelled run, or None if the cancel request failed
+    (e.g. the run already reached a terminal state).
+    """
+    try:
+        run = client.with_options(max_retries=0).beta.threads.runs.cancel(
+            thread_id=thread_id,
+            run_id=run_id,
+            timeout=CANCEL_REQUEST_TIMEOUT
+        )
+        print(f"\ncancelled run {run_id}")
+        return run
+    except Exception as e:
+        print(f"Error cancelling run {run_id}: {e}")
+        return None
+
 ### handle_run_result Handles the run result to determine next steps
 # Parameters:
 # run: the run object to handle
 # thread_id: thread id of the run
 # _func_caller: function(function_name, arguments) # calls and returns custom code.
 # Define once and implement your call_custom_function somewhere in your script.
+# deadline: absolute time.monotonic() deadline for the whole turn, computed from
+# turn_timeout (default TURN_TIMEOUT) on the first, non recursing call.
 # Returns string:
 # 'prompt_user' if the run is completed
 # 'continue_assistant' if the run is requires_action
 # else raise exception
 ###
 MAX_ITER = 20
-assistant_iteration = 0
-def handle_run_result(run=None,thread_id='',_func_caller=None,is_recursing=False):
-    global assistant_iteration
+# assistant_iteration safety counter, kept per thread so concurrent sessions don't share it
+run_loop_state = threading.local()
+def handle_run_result(run=None,thread_id='',_func_caller=None,is_recursing=False,deadline=None,turn_timeout=USE_TURN_TIMEOUT):
+    if not is_recursing and deadline is None:
+        deadline = make_deadline(turn_timeout)
 
-    run = get_processed_run(run, thread_id)
+    run = get_processed_run(run, thread_id, deadline=deadline)
     usage_data = process_run_usage(run)
 
-    # Add recursion info to usage data if it exists
+    # Add thread and recursion info to usage data if it exists
     if usage_data:
+        usage_data['thread_id'] = thread_id
         usage_data['is_recursing'] = is_recursing
 
     log_filepath = log_token_usage(usage_data)
     print(f"Logged usage data to {log_filepath}")
+    record_thread_prompt_tokens(thread_id, usage_data)
 
     if not is_recursing:
-        assistant_iteration = 0 # reset the safety counter
+        run_loop_state.assistant_iteration = 0 # reset the safety counter
     else:
+        assistant_iteration = getattr(run_loop_state, 'assistant_iteration', 0)
         if assistant_iteration >= MAX_ITER:
             raise Exception("MAX_ITER safety limit hit for assistant runs")
         else:
-            assistant_iteration += 1
-            print("\nassistant_iteration: {}".format(assistant_iteration))
+            run_loop_state.assistant_iteration = assistant_iteration + 1
+            print("\nassistant_iteration: {}".format(run_loop_state.assistant_iteration))
     match run.status:
         case 'completed':
             return 'prompt_user'
@@ -561,14 +683,16 @@ def handle_run_result(run=None,thread_id='',_func_caller=None,is_recursing=False
                     tool_calls=required_action.tool_calls,
                     run_id=run.id,
                     thread_id=thread_id,
-                    _func_caller=_func_caller
+                    _func_caller=_func_caller,
+                    deadline=deadline
                 )
 
                 return handle_run_result(
                     run=run,
                     thread_id=thread_id,
                     _func_caller=_func_caller,
-                    is_recursing=True
+                    is_recursing=True,
+                    deadline=deadline
                 )
         case 'cancelled':
             raise Exception('Assistant run cancelled')
@@ -661,8 +785,10 @@ def log_tool_calls(tool_calls, run_id, thread_id, base_dir="tmp/logs"):
 # tool_calls: list of tool calls
 # _func_caller: function(function_name, arguments) # calls and returns custom code.
 # Define once and implement your call_custom_function somewhere in your script.
+# deadline: optional absolute time.monotonic() deadline, tool calls are bounded by it
+# and the run is cancelled if it runs out before the outputs are submitted.
 # Returns run object after submitting tool outputs.
-def serve_tool_calls(tool_calls=None, run_id="", thread_id="", _func_caller=None):
+def serve_tool_calls(tool_calls=None, run_id="", thread_id="", _func_caller=None, deadline=None):
     function_outputs = []
 
     # Log the tool calls
@@ -673,14 +799,35 @@ def serve_tool_calls(tool_calls=None, run_id="", thread_id="", _func_caller=None
         function_name = tool_call.function.name
         arguments = json.loads(tool_call.function.arguments)
 
+        # Repeated read-only calls are served from the tool result cache.
+        # The fingerprint is taken before the call so a write racing the read can't
+        # get the old content cached under the new file state.
+        fingerprint = tool_call_fingerprint(function_name, arguments)
+        output = get_cached_tool_output(thread_id, function_name, arguments, fingerprint)
+        if output is not None:
+            print("cache hit for {}: {}".format(function_name, arguments))
+        elif function_name == "fetch_tool_output":
+            # Built in tool to page through outputs spilled by the output policy
+            output = fetch_tool_output(thread_id, arguments)
         # Check if the function is str_replace_editor
-        if function_name == "str_replace_editor":
+        elif function_name == "str_replace_editor":
             # Use the directly integrated handle_function_call function
             print("editor args: {}".format(arguments))
-            output = handle_function_call(function_name, arguments)
+            output = call_with_deadline(handle_function_call, function_name, arguments, deadline, run_id, thread_id)
+        elif function_name in PROCESS_POOL_TOOLS:
+            # CPU heavy custom tools run in worker processes so they don't hold the GIL
+            output = call_in_process_pool(PROCESS_POOL_TOOLS[function_name] or _func_caller, function_name, arguments, deadline, run_id, thread_id)
         else:
             # Use the provided function caller for other functions
-            output = _func_caller(function_name, arguments)
+            output = call_with_deadline(_func_caller, function_name, arguments, deadline, run_id, thread_id)
+
+        if is_write_tool_call(function_name, arguments):
+            # any write may change what earlier reads returned
+            clear_tool_cache(thread_id)
+        else:
+            cache_tool_output(thread_id, function_name, arguments, output, fingerprint)
+
+        output = apply_tool_output_policy(function_name, output, tool_call.id, run_id, thread_id)
 
         function_outputs.append({
             "tool_call_id": tool_call.id,
@@ -688,16 +835,497 @@ def serve_tool_calls(tool_calls=None, run_id="", thread_id="", _func_caller=None
         })
     print("tool_outputs: {}".format(str(function_outputs)[:500]))
 
-    run = client.beta.threads.runs.submit_tool_outputs(
+    if deadline_exceeded(deadline):
+        cancel_run(run_id, thread_id)
+        raise Exception('Assistant turn deadline exceeded before submitting tool outputs: run {} cancelled'.format(run_id))
+
+    run = call_api_with_deadline(
+        lambda api: api.beta.threads.runs.submit_tool_outputs(
                 thread_id=thread_id,
                 run_id=run_id,
                 tool_outputs=function_outputs
-            )
+            ),
+        deadline, run_id, thread_id, 'submitting tool outputs'
+    )
 
     # The run returned here will be in 'queued' or 'in_progress' state
     # We'll need to wait for it to complete and then log its usage
     return run
 
+def call_with_deadline(func, function_name, arguments, deadline, run_id, thread_id):
+    """
+    Calls func(function_name, arguments), bounded by the turn deadline.
+    The call runs inline and the run is cancelled and an exception raised if the
+    deadline has passed before or after it. With TOOL_CALL_THREADS the call runs on
+    its own daemon thread and is abandoned when the deadline hits. Python cannot
+    kill a thread, so the abandoned tool keeps running in the background.
+    """
+    if deadline is None:
+        return func(function_name, arguments)
+
+    remaining = time_remaining(deadline)
+    if remaining <= 0:
+        cancel_run(run_id, thread_id)
+        raise Exception('Assistant turn deadline exceeded before calling {}: run {} cancelled'.format(function_name, run_id))
+
+    if not TOOL_CALL_THREADS:
+        output = func(function_name, arguments)
+        if deadline_exceeded(deadline):
+            cancel_run(run_id, thread_id)
+            raise Exception('Tool call {} exceeded the assistant turn deadline: run {} cancelled'.format(function_name, run_id))
+        return output
+
+    result = {}
+    def run_tool():
+        try:
+            result['output'] = func(function_name, arguments)
+        except BaseException as e:
+            result['error'] = e
+    tool_thread = threading.Thread(target=run_tool, name=f"tool-call-{function_name}", daemon=True)
+    tool_thread.start()
+    tool_thread.join(remaining)
+    if tool_thread.is_alive():
+        cancel_run(run_id, thread_id)
+        raise Exception('Tool call {} exceeded the assistant turn deadline: run {} cancelled'.format(function_name, run_id))
+    if 'error' in result:
+        raise result['error']
+    return result['output']
+
+### Tool output policy
+# One oversized tool output inflates the prompt tokens and latency of every following run.
+# Before submit_tool_outputs each output is JSON minified and, if still over max_chars,
+# truncated to its head and tail around an elision marker. With spill enabled the full
+# output is stored locally under the tool call id, and the assistant can page through it
+# with the fetch_tool_output tool (add FETCH_TOOL_OUTPUT_TOOL to your assistant's tools).
+# Trimmed outputs are logged to tmp/logs/{thread_id}/tool_outputs.csv
+DEFAULT_TOOL_OUTPUT_POLICY = {
+    'max_chars': 20000,
+    'head_ratio': 0.7, # share of max_chars kept from the start of the output, the rest from the end
+    'minify_json': True,
+    'spill': True,
+}
+TOOL_OUTPUT_POLICIES = {
+    # fetched pages are already bounded by FETCH_TOOL_OUTPUT_PAGE_CHARS, never truncate them again
+    'fetch_tool_output': {'max_chars': None, 'spill': False, 'minify_json': False},
+}
+TOOL_OUTPUT_STORE_DIR = os.path.join("tmp", "tool-outputs")
+FETCH_TOOL_OUTPUT_PAGE_CHARS = 20000 # max characters of stored output per fetch
+FETCH_TOOL_OUTPUT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "fetch_tool_output",
+        "description": "Fetch part of a tool output that was truncated. Use the handle from the elision marker.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "handle": {"type": "string", "description": "Handle from the truncated output"},
+                "offset": {"type": "integer", "description": "Character offset to start from, default 0"},
+                "length": {"type": "integer", "description": "Number of characters to return"}
+            },
+            "required": ["handle"]
+        }
+    }
+}
+
+def set_tool_output_policy(function_name, **policy):
+    """
+    Overrides output policy settings for one tool, e.g.
+    set_tool_output_policy("str_replace_editor", max_chars=50000)
+    """
+    TOOL_OUTPUT_POLICIES.setdefault(function_name, {}).update(policy)
+
+def get_tool_output_policy(function_name):
+    return {**DEFAULT_TOOL_OUTPUT_POLICY, **TOOL_OUTPUT_POLICIES.get(function_name, {})}
+
+def minify_json_output(output):
+    """
+    Returns output re-encoded as compact JSON, or unchanged if it isn't JSON.
+    """
+    try:
+        return json.dumps(json.loads(output), separators=(',', ':'), ensure_ascii=False)
+    except ValueError:
+        return output
+
+def truncate_output(output, max_chars, head_ratio, handle=None):
+    """
+    Keeps the head and tail of output around an elision marker so the result fits max_chars.
+    """
+    def make_marker(elided):
+        marker = f"\n...[{elided} characters elided"
+        if handle:
+            marker += f", fetch_tool_output handle={handle}"
+        return marker + "]...\n"
+
+    # the marker length depends on the elided count, shrink keep until they agree
+    keep = max_chars
+    while True:
+        marker = make_marker(len(output) - keep)
+        new_keep = max(0, max_chars - len(marker))
+        if new_keep == keep:
+            break
+        keep = new_keep
+    head = int(keep * head_ratio)
+    tail = keep - head
+    return output[:head] + marker + (output[-tail:] if tail else "")
+
+def spill_tool_output(output, handle, thread_id):
+    thread_dir = os.path.join(TOOL_OUTPUT_STORE_DIR, thread_id)
+    os.makedirs(thread_dir, exist_ok=True)
+    filepath = os.path.join(thread_dir, f"{handle}.txt")
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(output)
+    return filepath
+
+def clear_tool_output_store(thread_id):
+    """
+    Removes the thread's spilled tool outputs.
+    """
+    shutil.rmtree(os.path.join(TOOL_OUTPUT_STORE_DIR, thread_id), ignore_errors=True)
+
+def fetch_tool_output(thread_id, arguments):
+    """
+    Serves the fetch_tool_output tool, returns a page of a spilled output.
+    """
+    handle = os.path.basename(str(arguments.get('handle', '')))
+    filepath = os.path.join(TOOL_OUTPUT_STORE_DIR, thread_id, f"{handle}.txt")
+    if not handle or not exists(filepath):
+        return json.dumps({
+            "content": f"Error: No stored output for handle {handle}",
+            "is_error": True
+        })
+
+    # offset and length come from the model, validate them
+    offset = arguments.get('offset')
+    length = arguments.get('length')
+    if offset is None:
+        offset = 0
+    if length is None:
+        length = FETCH_TOOL_OUTPUT_PAGE_CHARS
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        return json.dumps({
+            "content": f"Error: offset must be a non-negative integer, got {offset!r}",
+            "is_error": True
+        })
+    if not isinstance(length, int) or isinstance(length, bool) or length <= 0:
+        return json.dumps({
+            "content": f"Error: length must be a positive integer, got {length!r}",
+            "is_error": True
+        })
+    length = min(length, FETCH_TOOL_OUTPUT_PAGE_CHARS)
+
+    with open(filepath, 'r', encoding='utf-8') as f:
+        output = f.read()
+    page = output[offset:offset + length]
+    return json.dumps({
+        "content": page,
+        "offset": offset,
+        "total_chars": len(output),
+        "is_error": False
+    })
+
+def apply_tool_output_policy(function_name, output, tool_call_id, run_id, thread_id):
+    """
+    Applies the tool's output policy and returns the output to submit.
+    """
+    if not isinstance(output, str):
+        return output
+    policy = get_tool_output_policy(function_name)
+    original_chars = len(output)
+    if policy['minify_json']:
+        output = minify_json_output(output)
+    max_chars = policy['max_chars']
+    if max_chars is None or len(output) <= max_chars:
+        return output
+
+    handle = None
+    if policy['spill']:
+        handle = tool_call_id
+        spill_tool_output(output, handle, thread_id)
+    trimmed = truncate_output(output, max_chars, policy['head_ratio'], handle)
+    log_tool_output_trim({
+        'run_id': run_id,
+        'thread_id': thread_id,
+        'tool_call_id': tool_call_id,
+        'function_name': function_name,
+        'original_chars': original_chars,
+        'minified_chars': len(output),
+        'submitted_chars': len(trimmed),
+        'spill_handle': handle or '',
+    })
+    return trimmed
+
+def log_tool_output_trim(row_data, base_dir="tmp/logs"):
+    """
+    Logs how much of a tool output was trimmed to a CSV file in thread-specific folder structure:
+    tmp/logs/{thread_id}/tool_outputs.csv
+    """
+    import csv
+    from datetime import datetime
+
+    thread_dir = os.path.join(base_dir, row_data['thread_id'])
+    os.makedirs(thread_dir, exist_ok=True)
+    filepath = os.path.join(thread_dir, "tool_outputs.csv")
+    file_exists = os.path.isfile(filepath)
+
+    row_data = {'timestamp': datetime.now().isoformat(), **row_data}
+    with open(filepath, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=row_data.keys())
+        if not file_exists:
+            writer.writeheader()
+        writer.writerow(row_data)
+    return filepath
+
+### Process pool tools
+# CPU bound custom tools (image processing, template rendering, large JSON transforms)
+# hold the GIL and stall every other session in the process when run inline.
+# Tools registered with register_process_pool_tools run in a ProcessPoolExecutor instead.
+# Arguments are sent to the worker as a JSON string and non string results are JSON encoded,
+# so the tool function must be importable at module level (picklable) and the calling
+# script needs an `if __name__ == "__main__":` guard since workers are spawned.
+PROCESS_POOL_TOOLS = {} # {function_name: func or None to use the run's _func_caller}
+PROCESS_POOL_WORKERS = os.cpu_count() or 1
+PROCESS_POOL_TIMEOUT = 60 # seconds per tool call
+PROCESS_POOL_MAX_CALLS_PER_WORKER = 100 # workers are recycled after this many calls
+tool_process_pool = None
+process_pool_futures = {} # {pool: set of in flight futures}
+process_pool_lock = threading.Lock()
+
+def register_process_pool_tools(*function_names, func=None):
+    """
+    Routes the named custom tools to the process pool.
+    func: module level function(function_name, arguments) to run in the worker,
+    defaults to the _func_caller passed to serve_tool_calls.
+    """
+    for function_name in function_names:
+        PROCESS_POOL_TOOLS[function_name] = func
+
+def configure_process_pool(workers=None, timeout=None, max_calls_per_worker=None):
+    """
+    Updates the process pool settings. The running pool is shut down so the
+    next call starts one with the new settings.
+    """
+    global PROCESS_POOL_WORKERS, PROCESS_POOL_TIMEOUT, PROCESS_POOL_MAX_CALLS_PER_WORKER
+    if workers is not None:
+        PROCESS_POOL_WORKERS = workers
+    if timeout is not None:
+        PROCESS_POOL_TIMEOUT = timeout
+    if max_calls_per_worker is not None:
+        PROCESS_POOL_MAX_CALLS_PER_WORKER = max_calls_per_worker
+    shutdown_process_pool()
+
+def submit_to_process_pool(*args):
+    """
+    Submits a call to the current tool process pool, starting one if needed.
+    Returns (pool, future) so a timeout can retire the pool the call actually ran in.
+    """
+    global tool_process_pool
+    with process_pool_lock:
+        if tool_process_pool is None:
+            tool_process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PROCESS_POOL_WORKERS,
+                max_tasks_per_child=PROCESS_POOL_MAX_CALLS_PER_WORKER
+            )
+        pool = tool_process_pool
+        future = pool.submit(*args)
+        process_pool_futures.setdefault(pool, set()).add(future)
+    future.add_done_callback(lambda done: untrack_process_pool_future(pool, done))
+    return (pool, future)
+
+def untrack_process_pool_future(pool, future):
+    with process_pool_lock:
+        process_pool_futures.get(pool, set()).discard(future)
+
+def terminate_process_pool(pool):
+    # ProcessPoolExecutor has no public way to kill a stuck worker
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def retire_process_pool(pool, stuck_future=None):
+    """
+    Stops sending calls to pool, new calls start a fresh pool.
+    After a timeout the stuck worker has to be killed, but the pool may be running healthy
+    calls from other sessions, so its workers are terminated in the background only once
+    those calls finish or run past PROCESS_POOL_TIMEOUT.
+    """
+    global tool_process_pool
+    with process_pool_lock:
+        if tool_process_pool is pool:
+            tool_process_pool = None
+        if pool not in process_pool_futures:
+            return # already retired
+        others = [f for f in process_pool_futures.pop(pool) if f is not stuck_future]
+
+    def reap():
+        concurrent.futures.wait(others, timeout=PROCESS_POOL_TIMEOUT)
+        terminate_process_pool(pool)
+    threading.Thread(target=reap, daemon=True).start()
+
+def shutdown_process_pool(terminate=False):
+    """
+    Shuts down the tool process pool. terminate=True kills the workers
+    instead of waiting for running calls.
+    """
+    global tool_process_pool
+    with process_pool_lock:
+        pool = tool_process_pool
+        tool_process_pool = None
+        if pool is None:
+            return
+        process_pool_futures.pop(pool, None)
+    if terminate:
+        terminate_process_pool(pool)
+    else:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def run_process_pool_tool(func, function_name, arguments_json):
+    """
+    Runs inside the worker process, decodes the arguments and encodes the result.
+    """
+    output = func(function_name, json.loads(arguments_json))
+    if not isinstance(output, str):
+        output = json.dumps(output)
+    return output
+
+def call_in_process_pool(func, function_name, arguments, deadline, run_id, thread_id):
+    """
+    Calls func(function_name, arguments) in the tool process pool.
+    A call that runs past PROCESS_POOL_TIMEOUT returns an error output for the assistant
+    and the pool it ran in is retired. Running past the turn deadline cancels the run and raises.
+    """
+    timeout = PROCESS_POOL_TIMEOUT
+    remaining = time_remaining(deadline)
+    if remaining is not None:
+        if remaining <= 0:
+            cancel_run(run_id, thread_id)
+            raise Exception('Assistant turn deadline exceeded before calling {}: run {} cancelled'.format(function_name, run_id))
+        timeout = remaining if timeout is None else min(timeout, remaining)
+
+    (pool, future) = submit_to_process_pool(run_process_pool_tool, func, function_name, json.dumps(arguments))
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        retire_process_pool(pool, stuck_future=future)
+        if deadline_exceeded(deadline):
+            cancel_run(run_id, thread_id)
+            raise Exception('Tool call {} exceeded the assistant turn deadline: run {} cancelled'.format(function_name, run_id))
+        return json.dumps({
+            "content": f"Error: {function_name} timed out after {timeout} seconds",
+            "is_error": True
+        })
+    except concurrent.futures.BrokenExecutor as e:
+        # only the pool this call ran in is broken, its workers are already gone
+        retire_process_pool(pool, stuck_future=future)
+        return json.dumps({
+            "content": f"Error: {function_name} worker process died: {e}",
+            "is_error": True
+        })
+
+### Tool result memoization
+# Assistants often repeat the same read-only call within a conversation.
+# Results are cached per thread by (function_name, canonical arguments).
+# str_replace_editor view is always read-only, custom tools opt in with register_pure_tool.
+# Editor views are invalidated when the viewed path's mtime changes, and every
+# editor write command clears the thread's cache.
+# The cache is one LRU shared by all threads, bounded by entry count and output size.
+PURE_TOOLS = set()
+EDITOR_READ_COMMANDS = {'view'}
+TOOL_CACHE_MAX_ENTRIES = 2000
+TOOL_CACHE_MAX_CHARS = 32 * 1024 * 1024 # total characters of cached outputs
+TOOL_RESULT_CACHE = OrderedDict() # {(thread_id, function_name, canonical_arguments): (fingerprint, output)}, least recently used first
+tool_cache_chars = 0
+tool_cache_lock = threading.Lock()
+
+def register_pure_tool(*function_names):
+    """
+    Declares custom tools served by _func_caller as pure / read-only,
+    so their results can be reused for identical arguments within a thread.
+    """
+    PURE_TOOLS.update(function_names)
+
+def is_cacheable_tool_call(function_name, arguments):
+    if function_name == "str_replace_editor":
+        return arguments.get('command', 'view') in EDITOR_READ_COMMANDS
+    return function_name in PURE_TOOLS
+
+def is_write_tool_call(function_name, arguments):
+    return function_name == "str_replace_editor" and arguments.get('command', 'view') not in EDITOR_READ_COMMANDS
+
+def tool_call_fingerprint(function_name, arguments):
+    """
+    Returns the workspace state a cached result depends on.
+    For editor views that is the (mtime, size) of the viewed path, None if it doesn't exist.
+    """
+    if function_name != "str_replace_editor":
+        return None
+    safe_path = arguments.get('path', '/').replace('..', '')
+    try:
+        stat = os.stat(join(ASSISTANT_CHANGES_DIR, safe_path))
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def tool_cache_key(thread_id, function_name, arguments):
+    return (thread_id, function_name, json.dumps(arguments, sort_keys=True, separators=(',', ':')))
+
+def remove_cached_tool_output(key):
+    # call with tool_cache_lock held
+    global tool_cache_chars
+    (fingerprint, output) = TOOL_RESULT_CACHE.pop(key)
+    tool_cache_chars -= len(output)
+
+def get_cached_tool_output(thread_id, function_name, arguments, fingerprint):
+    """
+    Returns the cached output if it was cached under the current fingerprint, else None.
+    """
+    if not is_cacheable_tool_call(function_name, arguments):
+        return None
+    key = tool_cache_key(thread_id, function_name, arguments)
+    with tool_cache_lock:
+        cached = TOOL_RESULT_CACHE.get(key)
+        if cached is None:
+            return None
+        if cached[0] != fingerprint:
+            remove_cached_tool_output(key)
+            return None
+        TOOL_RESULT_CACHE.move_to_end(key)
+        return cached[1]
+
+def cache_tool_output(thread_id, function_name, arguments, output, fingerprint):
+    """
+    Caches output under the fingerprint taken before the call. If the workspace
+    changed while the tool ran the output may be stale, so it isn't cached.
+    """
+    global tool_cache_chars
+    if not is_cacheable_tool_call(function_name, arguments) or not isinstance(output, str):
+        return
+    if len(output) > TOOL_CACHE_MAX_CHARS:
+        return
+    if fingerprint != tool_call_fingerprint(function_name, arguments):
+        return
+    key = tool_cache_key(thread_id, function_name, arguments)
+    with tool_cache_lock:
+        if key in TOOL_RESULT_CACHE:
+            remove_cached_tool_output(key)
+        TOOL_RESULT_CACHE[key] = (fingerprint, output)
+        tool_cache_chars += len(output)
+        # evict least recently used entries
+        while len(TOOL_RESULT_CACHE) > TOOL_CACHE_MAX_ENTRIES or tool_cache_chars > TOOL_CACHE_MAX_CHARS:
+            remove_cached_tool_output(next(iter(TOOL_RESULT_CACHE)))
+
+def clear_tool_cache(thread_id=None):
+    """
+    Clears cached tool results for a thread, or for all threads if no thread_id is given.
+    """
+    global tool_cache_chars
+    with tool_cache_lock:
+        if thread_id is None:
+            TOOL_RESULT_CACHE.clear()
+            tool_cache_chars = 0
+        else:
+            for key in [key for key in TOOL_RESULT_CACHE if key[0] == thread_id]:
+                remove_cached_tool_output(key)
+
 ### Destructors
 def delete_files_from_openai(file_ids=[],vector_store_id=None):
     for file_id in file_ids:
@@ -746,6 +1374,9 @@ def delete_openai_file(file_id="",vector_store_id=None):
 
 def delete_thread(thread_id=''):
     result = client.beta.threads.delete(thread_id)
+    clear_tool_cache(thread_id)
+    clear_tool_output_store(thread_id)
+    THREAD_PROMPT_TOKENS.pop(thread_id, None)
     if result.deleted:
         print('successfully deleted thread')
     else:
@@ -767,7 +1398,8 @@ def clear_openai_storage(vector_store_id=None):
         print(f"Done deleting, vector store should be gone\n{result}")
 
 def clear_assistant_tmp():
-    tmp_dir = Path("tmp/assistant-changes")
+    tmp_dir = Path(ASSISTANT_CHANGES_DIR)
+    clear_tool_cache()
     if tmp_dir.exists():
         shutil.rmtree(tmp_dir)
         print("Temporary directory 'tmp/assistant-changes' has been cleared.")
@@ -799,3 +1431,98 @@ def process_run_usage(run):
         usage_data['total_tokens'] = "N/A"
 
     return usage_data
+
+### Thread compaction
+# prompt_tokens grows with every turn of a long session, raising latency and cost.
+# handle_run_result records cumulative prompt tokens per thread, and between turns
+# compact_thread_if_needed replaces a thread that crossed COMPACTION_THRESHOLD with
+# a fresh thread seeded with a summary of the conversation.
+COMPACTION_THRESHOLD = 200000 # cumulative prompt tokens per thread
+COMPACTION_MODEL = "gpt-4o-mini"
+COMPACTION_PROMPT = (
+    "Summarize the conversation below so it can continue in a new thread. "
+    "Keep the user's goals, decisions made, file paths and code changes, open questions and any facts still needed. "
+    "Be concise."
+)
+THREAD_PROMPT_TOKENS = {} # {thread_id: cumulative prompt tokens}
+
+def record_thread_prompt_tokens(thread_id, usage_data):
+    """
+    Adds the run's prompt tokens to the thread's running total.
+    Returns the new total.
+    """
+    total = THREAD_PROMPT_TOKENS.get(thread_id, 0)
+    if usage_data and isinstance(usage_data.get('prompt_tokens'), int):
+        total += usage_data['prompt_tokens']
+        THREAD_PROMPT_TOKENS[thread_id] = total
+    return total
+
+def get_thread_transcript(thread_id):
+    """
+    Returns the thread's text messages oldest first as 'role: text' lines.
+    """
+    lines = []
+    for m in client.beta.threads.messages.list(thread_id=thread_id, order="asc"):
+        for content in m.content:
+            if content.type == "text":
+                lines.append(f"{m.role}: {content.text.value}")
+    return "\n\n".join(lines)
+
+def summarize_thread(thread_id):
+    """
+    Default compaction strategy, summarizes the thread with COMPACTION_MODEL.
+    Returns the summary string.
+    """
+    response = client.chat.completions.create(
+        model=COMPACTION_MODEL,
+        messages=[
+            {"role": "system", "content": COMPACTION_PROMPT},
+            {"role": "user", "content": get_thread_transcript(thread_id)}
+        ]
+    )
+    return response.choices[0].message.content
+
+def compact_thread(thread_id, strategy=None, delete_old_thread=False):
+    """
+    Summarizes a thread and starts a fresh thread seeded with the summary,
+    keeping the old thread's tool_resources and metadata.
+    strategy: function(thread_id) returning the summary string, defaults to summarize_thread.
+    Returns the new thread id, the caller should use it from now on.
+    """
+    strategy = strategy or summarize_thread
+    summary = strategy(thread_id)
+
+    # carry over attached vector stores / code interpreter files and metadata
+    old_thread = client.beta.threads.retrieve(thread_id)
+    thread_options = {}
+    if old_thread.tool_resources is not None:
+        thread_options['tool_resources'] = old_thread.tool_resources.model_dump(exclude_none=True)
+    if old_thread.metadata:
+        thread_options['metadata'] = old_thread.metadata
+
+    new_thread = client.beta.threads.create(
+        messages=[{
+            "role": "user",
+            "content": f"Summary of our conversation so far:\n{summary}"
+        }],
+        **thread_options
+    )
+    print(f"compacted thread {thread_id} ({THREAD_PROMPT_TOKENS.get(thread_id, 0)} prompt tokens) into {new_thread.id}")
+
+    THREAD_PROMPT_TOKENS.pop(thread_id, None)
+    clear_tool_cache(thread_id)
+    clear_tool_output_store(thread_id)
+    if delete_old_thread:
+        delete_thread(thread_id)
+    return new_thread.id
+
+def compact_thread_if_needed(thread_id, threshold=None, strategy=None, delete_old_thread=False):
+    """
+    Call between turns, e.g. when handle_run_result returns 'prompt_user'.
+    Compacts the thread if its cumulative prompt tokens crossed the threshold
+    (default COMPACTION_THRESHOLD). Returns the thread id to use next.
+    """
+    threshold = COMPACTION_THRESHOLD if threshold is None else threshold
+    if THREAD_PROMPT_TOKENS.get(thread_id, 0) < threshold:
+        return thread_id
+    return compact_thread(thread_id, strategy=strategy, delete_old_thread=delete_old_thread)